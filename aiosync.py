@@ -0,0 +1,325 @@
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import urlencode
+
+import aiohttp
+from oauthlib.oauth1 import Client
+
+from metrics import API_CALLS, API_LATENCY, COALESCED, EXPENSES_CONVERTED, \
+    EXPENSES_SCANNED, SYNC_DURATION
+from ratelimit import retry_after
+from sessions import endpoint, get_limiter, RATE_LIMITED_RETRIES, RETRIES
+from settings import config, app_setting
+import sync
+from sync import Call
+
+# asyncio versions of the Splitwise and fixer.io clients, and of
+# update_all, for syncs with far more calls in flight than the thread
+# pools manage. Runs the same steps as sync.py (see sync.Call), with the
+# DB work still done synchronously between awaits, as the session is
+# shared by every user on the loop. Python 3 only, so sync.py only
+# imports it for --async.
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (500, 502, 503, 504)
+# Same as requests' Retry: POSTs are only retried if they never got sent
+IDEMPOTENT = ("GET", "PUT", "DELETE")
+
+# (day, base) -> the fetch already in flight, as with Rate.fetch_rates
+rate_flights = {}
+
+
+class Response(object):
+    def __init__(self, response, body):
+        self.status_code = response.status
+        self.headers = response.headers
+        self.response = response
+        self.body = body
+
+    def raise_for_status(self):
+        self.response.raise_for_status()
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+
+async def timed(session, service, method, url, **kwargs):
+    labels = {"service": service, "endpoint": endpoint(url)}
+    status = "error"
+    try:
+        with API_LATENCY.time(**labels):
+            async with session.request(method, url, **kwargs) as response:
+                body = await response.read()
+        status = response.status
+        return Response(response, body)
+    finally:
+        API_CALLS.inc(status=status, **labels)
+
+
+async def request(session, service, method, url, **kwargs):
+    # Retries connection failures and 5xx responses, with backoff
+    attempt = 0
+    while True:
+        try:
+            response = await timed(session, service, method, url, **kwargs)
+            if response.status_code not in RETRY_STATUSES or \
+                    method not in IDEMPOTENT or attempt >= RETRIES:
+                return response
+        except aiohttp.ClientConnectorError:
+            if attempt >= RETRIES:
+                raise
+        except aiohttp.ClientError:
+            if method not in IDEMPOTENT or attempt >= RETRIES:
+                raise
+        await asyncio.sleep(0.5 * (2 ** attempt))
+        attempt += 1
+
+
+async def blocking(fn, *args):
+    # For the limiter, which sleeps and talks to the DB
+    return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+
+class Splitwise(object):
+    # One per user, signing each call the same way OAuth1Session does.
+    # At most `limit` of their calls are in flight at once.
+
+    def __init__(self, session, user, limit):
+        self.session = session
+        self.oauth = Client(
+            config["splitwise"]["client_id"],
+            client_secret=config["splitwise"]["client_secret"],
+            resource_owner_key=user.resource_owner_key,
+            resource_owner_secret=user.resource_owner_secret)
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def request(self, call):
+        body = None
+        headers = {}
+        if call.data is not None:
+            body = urlencode(call.data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        async with self.semaphore:
+            attempt = 0
+            while True:
+                limiter = get_limiter()
+                if limiter is not None:
+                    await blocking(limiter.acquire)
+                url, signed, body = self.oauth.sign(
+                    call.url, call.method, body, headers)
+                response = await request(
+                    self.session, "splitwise", call.method, url,
+                    headers=signed, data=body)
+                if response.status_code != 429 or \
+                        attempt >= RATE_LIMITED_RETRIES:
+                    break
+                attempt += 1
+                wait = retry_after(response)
+                if limiter is not None:
+                    await blocking(limiter.block, wait)
+                else:
+                    await asyncio.sleep(wait)
+        response.raise_for_status()
+        return response.json()
+
+
+async def run_calls(api, calls):
+    # sync.run_calls, but awaiting each call
+    try:
+        call = next(calls)
+        while True:
+            call = calls.send(await api.request(call))
+    except StopIteration:
+        pass
+    finally:
+        calls.close()
+
+
+async def fetch_rates(session, day, base):
+    key = (day, base)
+    if key in rate_flights:
+        COALESCED.inc(flight="rates")
+    else:
+        rate_flights[key] = asyncio.ensure_future(
+            request_rates(session, day, base))
+        rate_flights[key].add_done_callback(
+            lambda _: rate_flights.pop(key))
+    # So one caller giving up doesn't cancel it for everyone else
+    return await asyncio.shield(rate_flights[key])
+
+
+async def request_rates(session, day, base):
+    Rate = sync.Rate
+    response = await request(
+        session, "rates", "GET", Rate.rates_url(day, base))
+    response.raise_for_status()
+    return Rate.parse_rates(response.json(), base)
+
+
+async def prefetch(session, days, base):
+    # Rate.prefetch, with every missing day fetched at once
+    Rate = sync.Rate
+    table, to_fetch = Rate.lookup(days, base)
+    if len(to_fetch) == 0:
+        return table
+    fetched = await asyncio.gather(
+        *[fetch_rates(session, day, base) for day in to_fetch])
+    return Rate.remember(base, table, zip(to_fetch, fetched))
+
+
+async def wrong_expenses_page(api, expenses, currency, uow, snapshot):
+    known = uow.load(expense["id"] for expense in expenses)
+    changed, to_scan = sync.comments_to_scan(expenses, known)
+    comments = await asyncio.gather(
+        *[api.request(sync.comments_call(id)) for id in to_scan])
+    sync.read_comments(
+        changed, dict(zip(to_scan, [c["comments"] for c in comments])),
+        known, uow)
+    to_convert = sync.find_conversions(expenses, currency, known)
+    rates = await prefetch(
+        api.session, sync.conversion_days(to_convert), currency)
+    return sync.price_conversions(to_convert, currency, rates, snapshot)
+
+
+async def scan_expenses(api, user, currency, uow):
+    # The next page is fetched while this one's comments and rates are
+    wrong = []
+    cursor = None
+    snapshot = {}
+    page_size = sync.expenses_page_size()
+    offset = 0
+    pending = asyncio.ensure_future(api.request(
+        Call("GET", user.expenses_url(page_size, offset))))
+    try:
+        while True:
+            expenses = (await pending)["expenses"]
+            last = len(expenses) < page_size
+            if not last:
+                offset += page_size
+                pending = asyncio.ensure_future(api.request(
+                    Call("GET", user.expenses_url(page_size, offset))))
+            EXPENSES_SCANNED.inc(len(expenses))
+            wrong.extend(await wrong_expenses_page(
+                api, expenses, currency, uow, snapshot))
+            cursor = sync.page_cursor(expenses, cursor)
+            if last:
+                return wrong, cursor, snapshot
+    finally:
+        pending.cancel()
+
+
+async def run_steps(api, steps, uow, progress=None, failed=0, known=None,
+                    snapshot=None):
+    # sync.run_steps, with up to api.limit expenses being updated at once
+    if known is None:
+        known = uow.load(step.expense_id for step in steps)
+    if snapshot is None:
+        snapshot = {}
+    steps, given_up = sync.runnable_steps(steps)
+    failed += given_up
+    total = len(steps) + failed
+    converted = [0]
+    pending = iter(steps)
+
+    async def worker():
+        for step in pending:
+            try:
+                await run_calls(api, sync.update_expense_calls(
+                    step.expense_id, step.currency, step.rate, known,
+                    snapshot.get(step.expense_id), uow, step))
+            except asyncio.CancelledError:
+                # Someone else's failure, not this step's
+                raise
+            except Exception:
+                step.fail()
+                raise
+            converted[0] += 1
+            EXPENSES_CONVERTED.inc()
+            if progress is not None:
+                progress(converted[0], total, failed)
+
+    if progress is not None:
+        progress(0, total, failed)
+    workers = [asyncio.ensure_future(worker())
+               for _ in range(min(api.limit, len(steps)))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def update_all(session, user, progress=None):
+    with SYNC_DURATION.time():
+        api = Splitwise(
+            session, user, app_setting("async_user_concurrency", 8))
+        currency = sync.default_currency(
+            await api.request(sync.current_user_call()))
+        uow = sync.unit_of_work()
+        steps = sync.SyncStep.resume(user)
+        given_up = set()
+        if len(steps) > 0:
+            logger.info("Resuming %d expenses for %r", len(steps), user)
+            await run_steps(api, steps, uow, progress)
+            given_up = sync.finish_steps(user, steps, uow)
+
+        wrong, cursor, snapshot = await scan_expenses(
+            api, user, currency, uow)
+        cursor = sync.hold_cursor(cursor, given_up, snapshot)
+        steps, known = sync.plan_steps(
+            user, currency, cursor, wrong, uow, given_up)
+        await run_steps(api, steps, uow, progress, len(wrong) - len(steps),
+                        known, snapshot)
+        sync.finish_sync(user, cursor, uow)
+
+
+async def sync_user(session, user_id):
+    # sync.sync_user, but the DB session is shared with everyone else on
+    # the loop, so it's only thrown away once they're all done
+    start = time.time()
+    error = None
+    if not sync.User.claim(user_id, sync.lease_owner(), sync.lease_seconds()):
+        return None
+    try:
+        user = sync.User.query.get(user_id)
+        print("Updating %r" % user)
+        await update_all(session, user, progress=sync.keep_lease(user_id))
+        sync.db.session.commit()
+    except Exception as e:
+        logger.exception("Failed to update user %d", user_id)
+        sync.db.session.rollback()
+        error = e
+    finally:
+        sync.User.release(user_id, sync.lease_owner())
+    return (time.time() - start, error)
+
+
+async def sync_users(user_ids, workers):
+    # The connector limit bounds calls across every user at once
+    connector = aiohttp.TCPConnector(
+        limit=app_setting("async_concurrency", 32))
+    async with aiohttp.ClientSession(connector=connector) as session:
+        semaphore = asyncio.Semaphore(workers)
+
+        async def one(user_id):
+            async with semaphore:
+                return await sync_user(session, user_id)
+        return await asyncio.gather(*[one(id) for id in user_ids])
+
+
+def sync_all_users(workers):
+    users = sync.registered_users()
+    if len(users) == 0:
+        return True
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(
+            sync_users([user.id for user in users], max(1, workers)))
+    finally:
+        loop.close()
+    return sync.summarise(users, results)
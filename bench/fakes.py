@@ -0,0 +1,227 @@
+import datetime
+import json
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+CURRENCIES = [
+    "GBP", "EUR", "USD", "JPY", "CHF", "AUD", "CAD", "SEK", "NOK", "DKK",
+    "PLN", "CZK", "HUF", "NZD", "SGD", "HKD"]
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # lots of keep-alive clients at once
+    request_queue_size = 128
+
+
+class Fake(object):
+    # Base for the stand-ins: a threaded HTTP server on a free local port
+    # that counts calls per endpoint and sleeps for `latency` on each one
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are separate writes
+            disable_nagle_algorithm = True
+
+            def handle_any(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                form = parse_qs(self.rfile.read(length).decode("utf-8"))
+                form = dict((k, v[0]) for (k, v) in form.items())
+                query = dict(
+                    (k, v[0]) for (k, v) in parse_qs(url.query).items())
+                if fake.latency > 0:
+                    time.sleep(fake.latency)
+                status, data = fake.handle(
+                    method, url.path, query, form, self.headers)
+                fake.count(url.path)
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.handle_any("GET")
+
+            def do_POST(self):
+                self.handle_any("POST")
+
+            def do_PUT(self):
+                self.handle_any("PUT")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def count(self, path):
+        # Collapse ids so calls group by endpoint
+        endpoint = re.sub(r"/\d[\d-]*", "/<id>", path)
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+
+    def total(self):
+        return sum(self.calls.values())
+
+    def handle(self, method, path, query, form, headers):
+        raise NotImplementedError
+
+
+def when(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class FakeSplitwise(Fake):
+    # Enough of the v3.0 API for a sync. Every user (OAuth token) gets
+    # their own expenses, each with `comments` plain comments on it.
+
+    def __init__(self, users, expenses, comments, currencies, days=365,
+                 latency=0.0, seed=0):
+        Fake.__init__(self, latency)
+        self.currencies = CURRENCIES[:max(1, currencies)]
+        random.seed(seed)
+        self.users = {}
+        self.expenses = {}
+        self.comments = {}
+        start = datetime.datetime(2017, 1, 1, 12, 0, 0)
+        next_id = [1]
+
+        def new_id():
+            next_id[0] += 1
+            return next_id[0]
+
+        for user in range(users):
+            token = "token%d" % user
+            self.users[token] = {"id": user + 1, "expenses": []}
+            for _ in range(expenses):
+                id = new_id()
+                created = start + datetime.timedelta(
+                    days=random.randrange(days))
+                cost = "%.2f" % (random.randrange(100, 100000) / 100.0)
+                self.expenses[id] = {
+                    "id": id,
+                    "description": "Expense %d" % id,
+                    "cost": cost,
+                    "currency_code": random.choice(self.currencies),
+                    "created_at": when(created),
+                    "updated_at": when(created),
+                    "comments_count": comments,
+                    "users": [
+                        {"user_id": user + 1, "paid_share": cost,
+                         "owed_share": cost}]}
+                self.comments[id] = [
+                    {"id": new_id(), "content": "Comment %d" % c,
+                     "deleted_at": None}
+                    for c in range(comments)]
+                self.users[token]["expenses"].append(id)
+        self.new_id = new_id
+
+    def user_for(self, headers):
+        auth = headers.get("Authorization", "")
+        token = re.search(r'oauth_token="([^"]+)"', auth)
+        return self.users[token.group(1)]
+
+    def handle(self, method, path, query, form, headers):
+        user = self.user_for(headers)
+        name = path.rstrip("/").split("/")
+        if name[-1] == "get_current_user":
+            return 200, {"user": {
+                "id": user["id"], "default_currency": self.currencies[0]}}
+        if name[-1] == "get_expenses":
+            found = [self.expenses[id] for id in user["expenses"]]
+            if "updated_after" in query:
+                found = [e for e in found
+                         if e["updated_at"] > query["updated_after"]]
+            found.sort(key=lambda e: e["updated_at"], reverse=True)
+            offset = int(query.get("offset", 0))
+            limit = int(query.get("limit", 20))
+            if limit > 0:
+                found = found[offset:offset + limit]
+            else:
+                found = found[offset:]
+            return 200, {"expenses": found}
+        if name[-1] == "get_comments":
+            return 200, {"comments": self.comments[int(query["expense_id"])]}
+        if name[-2] == "get_expense":
+            return 200, {"expense": self.expenses[int(name[-1])]}
+        if name[-2] == "update_expense":
+            return 200, self.update_expense(int(name[-1]), form)
+        if name[-1] == "create_comment":
+            expense = self.expenses[int(form["expense_id"])]
+            comment = {"id": self.new_id(), "content": form["content"],
+                       "deleted_at": None}
+            self.comments[expense["id"]].append(comment)
+            expense["comments_count"] += 1
+            return 200, {"comment": comment, "errors": {}}
+        if name[-2] == "delete_comment":
+            id = int(name[-1])
+            for expense_id, comments in self.comments.items():
+                for comment in comments:
+                    if comment["id"] == id:
+                        comment["deleted_at"] = when(
+                            datetime.datetime.utcnow())
+                        self.expenses[expense_id]["comments_count"] -= 1
+            return 200, {"success": True}
+        return 404, {"errors": {"base": ["Unknown %s" % path]}}
+
+    def update_expense(self, id, form):
+        expense = self.expenses[id]
+        expense["currency_code"] = form["currency_code"]
+        expense["cost"] = form["cost"]
+        for idx, share in enumerate(expense["users"]):
+            for key in ("paid_share", "owed_share"):
+                field = "users__array_%d__%s" % (idx, key)
+                if field in form:
+                    share[key] = form[field]
+        expense["updated_at"] = when(datetime.datetime.utcnow())
+        return {"expenses": [expense], "errors": {}}
+
+
+class FakeRates(Fake):
+    # fixer.io style /<date>?base=X, with made up but consistent rates
+
+    def __init__(self, currencies, latency=0.0):
+        Fake.__init__(self, latency)
+        self.currencies = CURRENCIES[:max(1, currencies)]
+
+    def rate(self, currency, day):
+        # value of 1 EUR, wobbling a bit by day
+        index = CURRENCIES.index(currency)
+        return (1.0 + index * 0.37) * (1.0 + (day.toordinal() % 17) / 100.0)
+
+    def handle(self, method, path, query, form, headers):
+        day = datetime.datetime.strptime(path.strip("/"), "%Y-%m-%d").date()
+        base = query["base"]
+        rates = dict(
+            (currency, round(self.rate(currency, day) /
+                             self.rate(base, day), 6))
+            for currency in self.currencies if currency != base)
+        return 200, {"base": base, "date": str(day), "rates": rates}
@@ -0,0 +1,162 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeSplitwise, FakeRates  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Benchmark syncing against local Splitwise/fixer stand-ins")
+parser.add_argument("--users", type=int, default=3)
+parser.add_argument("--expenses", type=int, default=200,
+                    help="expenses per user")
+parser.add_argument("--comments", type=int, default=1,
+                    help="comments per expense")
+parser.add_argument("--currencies", type=int, default=4,
+                    help="currencies the expenses are spread over")
+parser.add_argument("--days", type=int, default=120,
+                    help="days the expenses are spread over")
+parser.add_argument("--latency", type=float, default=0.02,
+                    help="seconds added to each Splitwise call")
+parser.add_argument("--rates-latency", type=float, default=0.05,
+                    help="seconds added to each rate call")
+parser.add_argument("--workers", type=int, default=2,
+                    help="parallel users for the CLI sync")
+parser.add_argument("--async", dest="use_async", action="store_true",
+                    help="run the CLI sync with aiosync rather than threads")
+parser.add_argument("--database", default=None,
+                    help="database URI (default: a temporary SQLite file)")
+parser.add_argument("--json", action="store_true",
+                    help="print the results as JSON")
+args = parser.parse_args()
+
+splitwise = FakeSplitwise(
+    args.users, args.expenses, args.comments, args.currencies,
+    days=args.days, latency=args.latency).start()
+rates = FakeRates(args.currencies, latency=args.rates_latency).start()
+
+database = args.database
+if database is None:
+    database = "sqlite:///" + os.path.join(
+        tempfile.mkdtemp(prefix="moolah-bench"), "bench.db")
+
+# settings.py reads these when it sees DYNO, so no config.yaml is needed
+os.environ.update({
+    "DYNO": "bench",
+    "DATABASE_URL": database,
+    "CLIENT_ID": "bench",
+    "CLIENT_SECRET": "bench",
+    "FLASK_ENCRYPTION_KEY": "bench",
+    "SPLITWISE_API": "http://127.0.0.1:%d/api/v3.0/" %
+                     splitwise.server.server_port,
+    "RATES_API": "http://127.0.0.1:%d/" % rates.server.server_port,
+    "SPLITWISE_RATE": "0",
+})
+os.chdir(root)
+
+import fixer  # noqa: E402
+import sync  # noqa: E402
+from flask_migrate import upgrade  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+queries = [0]
+
+
+@event.listens_for(fixer.db.engine, "before_cursor_execute")
+def count_query(*args):
+    queries[0] += 1
+
+
+with fixer.app.app_context():
+    upgrade()
+    for token, info in sorted(splitwise.users.items()):
+        user = fixer.User(token, "secret-" + token)
+        user.splitwise_id = info["id"]
+        fixer.db.session.add(user)
+    fixer.db.session.commit()
+    first = fixer.User.query.order_by(fixer.User.id).first()
+    first_id = (first.id, first.splitwise_id)
+    fixer.db.session.remove()
+
+results = []
+
+
+def measure(name, run):
+    splitwise.reset()
+    rates.reset()
+    queries[0] = 0
+    tracemalloc.start()
+    start = time.time()
+    # The sync's own "Updating ..."/"Summary:" lines, away from the results
+    with contextlib.redirect_stdout(sys.stderr):
+        run()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.append({
+        "scenario": name,
+        "wall": elapsed,
+        "splitwise_calls": splitwise.total(),
+        "rate_calls": rates.total(),
+        "db_queries": queries[0],
+        "peak_mib": peak / (1024.0 * 1024.0),
+        "endpoints": dict(splitwise.calls)})
+
+
+fixer.app.config["PROPAGATE_EXCEPTIONS"] = True
+client = fixer.app.test_client()
+with client.session_transaction() as session:
+    session["splitwise_id"] = first_id[1]
+
+
+def index():
+    response = client.get("/")
+    assert response.status_code == 200, response.status_code
+
+
+def update_all():
+    with fixer.app.app_context():
+        sync.update_all(fixer.User.query.get(first_id[0]))
+        fixer.db.session.commit()
+        fixer.db.session.remove()
+
+
+def cli():
+    with fixer.app.app_context():
+        if args.use_async:
+            import aiosync
+            assert aiosync.sync_all_users(args.workers)
+        else:
+            assert sync.sync_all_users(args.workers)
+        fixer.db.session.remove()
+
+
+# Order matters: each step leaves the data as a real deployment would
+measure("index (cold)", index)
+measure("index (cached)", index)
+measure("update_all (first sync, 1 user)", update_all)
+measure("cli (%d users, %d workers)" % (args.users, args.workers), cli)
+measure("cli (nothing changed)", cli)
+
+splitwise.stop()
+rates.stop()
+
+if args.json:
+    print(json.dumps(results, indent=2, sort_keys=True))
+else:
+    print()
+    print("%-34s %8s %10s %6s %8s %9s" % (
+        "scenario", "wall (s)", "splitwise", "rates", "queries",
+        "peak MiB"))
+    for result in results:
+        print("%-34s %8.2f %10d %6d %8d %9.1f" % (
+            result["scenario"], result["wall"], result["splitwise_calls"],
+            result["rate_calls"], result["db_queries"], result["peak_mib"]))
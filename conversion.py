@@ -0,0 +1,63 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+# Money as integer minor units (pennies/cents), so that converted shares
+# always add up to exactly the converted cost, however many people an
+# expense is split between.
+
+
+def to_minor(value, places=2):
+    units = Decimal(str(value)).scaleb(places)
+    return int(units.to_integral_value(ROUND_HALF_UP))
+
+
+def from_minor(units, places=2):
+    return Decimal(units).scaleb(-places)
+
+
+def convert(units, rate):
+    # rate is how much of the original currency one of the new one costs,
+    # as fixer gives it with base=<new currency>
+    units = Decimal(units) / Decimal(str(rate))
+    return int(units.to_integral_value(ROUND_HALF_UP))
+
+
+def split(total, weights):
+    # Largest remainder: share out `total` in proportion to `weights`,
+    # then hand the units left over from rounding down to the biggest
+    # fractional parts (earliest first on ties)
+    weight = sum(weights)
+    if weight == 0:
+        if total != 0:
+            raise ValueError("Can't split %d between nothing" % total)
+        return [0] * len(weights)
+    if weight < 0:
+        return [-share for share in split(-total, [-w for w in weights])]
+    shares = []
+    remainders = []
+    for w in weights:
+        share, remainder = divmod(total * w, weight)
+        shares.append(share)
+        remainders.append(remainder)
+    left = total - sum(shares)
+    order = sorted(range(len(weights)), key=lambda idx: -remainders[idx])
+    for idx in order[:left]:
+        shares[idx] += 1
+    return shares
+
+
+def convert_expense(cost, users, rate, places=2):
+    # cost in the original currency, users as Splitwise gives them (in
+    # whatever currency the expense is now). Returns the new cost and
+    # (paid, owed) for each user, all in minor units of the new currency.
+    total = convert(to_minor(cost, places), rate)
+    paid = split(total, [to_minor(u["paid_share"] or 0, places)
+                         for u in users])
+    owed = split(total, [to_minor(u["owed_share"] or 0, places)
+                         for u in users])
+    return total, list(zip(paid, owed))
+
+
+def convert_values(values, rates, places=2):
+    # Just the totals, for showing what a conversion will come to
+    return [from_minor(convert(to_minor(value, places), rate), places)
+            for (value, rate) in zip(values, rates)]
@@ -0,0 +1,29 @@
+import re
+import sqlalchemy
+from sqlalchemy import orm
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
+
+# Just enough of Flask-SQLAlchemy's `db` for build_models, so the sync can
+# run without Flask
+
+
+class Database(object):
+    def __init__(self, uri, echo=False):
+        self.engine = sqlalchemy.create_engine(uri, echo=echo)
+        self.session = orm.scoped_session(
+            orm.sessionmaker(bind=self.engine))
+
+        class Base(object):
+            @declared_attr
+            def __tablename__(cls):
+                # Same names as Flask-SQLAlchemy gives them
+                return re.sub(
+                    r'((?<=[a-z0-9])[A-Z]|(?!^)[A-Z](?=[a-z]))', r'_\1',
+                    cls.__name__).lower()
+
+        self.Model = declarative_base(cls=Base)
+        self.Model.query = self.session.query_property()
+        for module in (sqlalchemy, orm):
+            for name in module.__all__:
+                if not hasattr(self, name):
+                    setattr(self, name, getattr(module, name))
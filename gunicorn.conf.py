@@ -0,0 +1,14 @@
+# Used with --preload (see the Procfile), so the app is imported once in
+# the master and the workers fork from it ready to serve.
+
+
+def on_starting(server):
+    # Refuse to start on a database the release phase hasn't migrated
+    from sync import check_schema
+    check_schema()
+
+
+def pre_fork(server, worker):
+    # Don't share the master's DB connections with the workers
+    from fixer import db
+    db.engine.dispose()
@@ -0,0 +1,129 @@
+import threading
+import time
+
+# Always-on, in-process counters and histograms, rendered in the Prometheus
+# text format. Each process (web worker, CLI run, job worker) has its own.
+
+_lock = threading.Lock()
+_metrics = []
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    labels = list(key) + list(extra)
+    if len(labels) == 0:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace('"', '\\"'))
+        for (name, value) in labels)
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        with _lock:
+            _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def lines(self):
+        for key, value in sorted(self.values.items()):
+            yield "%s%s %s" % (self.name, _format_labels(key), value)
+
+
+class Histogram(object):
+    kind = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self, name, help, buckets=None):
+        self.name = name
+        self.help = help
+        self.buckets = buckets or self.BUCKETS
+        # labels -> [per bucket counts..., sum, count]
+        self.values = {}
+        with _lock:
+            _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        with _lock:
+            if key not in self.values:
+                self.values[key] = [0] * (len(self.buckets) + 2)
+            counts = self.values[key]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def lines(self):
+        for key, counts in sorted(self.values.items()):
+            for idx, bound in enumerate(self.buckets):
+                yield "%s_bucket%s %d" % (
+                    self.name, _format_labels(key, [("le", bound)]),
+                    counts[idx])
+            yield "%s_bucket%s %d" % (
+                self.name, _format_labels(key, [("le", "+Inf")]),
+                counts[-1])
+            yield "%s_sum%s %s" % (self.name, _format_labels(key), counts[-2])
+            yield "%s_count%s %d" % (
+                self.name, _format_labels(key), counts[-1])
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+def render():
+    out = []
+    with _lock:
+        for metric in _metrics:
+            out.append("# HELP %s %s" % (metric.name, metric.help))
+            out.append("# TYPE %s %s" % (metric.name, metric.kind))
+            out.extend(metric.lines())
+    return "\n".join(out) + "\n"
+
+
+API_CALLS = Counter(
+    "moolah_api_calls_total", "Calls to Splitwise and the rates service")
+API_LATENCY = Histogram(
+    "moolah_api_call_seconds", "Latency of Splitwise and rates calls")
+DB_QUERIES = Histogram(
+    "moolah_db_queries_per_request", "DB queries made by each web request",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000))
+REQUEST_LATENCY = Histogram(
+    "moolah_request_seconds", "Time taken to serve each web request")
+EXPENSES_SCANNED = Counter(
+    "moolah_expenses_scanned_total", "Expenses looked at by syncs")
+EXPENSES_CONVERTED = Counter(
+    "moolah_expenses_converted_total", "Expenses converted by syncs")
+SYNC_DURATION = Histogram(
+    "moolah_sync_seconds", "Time taken by update_all for one user")
+CACHE = Counter(
+    "moolah_cache_total", "Cache lookups, by cache and hit/miss")
+COALESCED = Counter(
+    "moolah_coalesced_total",
+    "Calls that shared the result of an identical one already in flight")
@@ -0,0 +1,26 @@
+"""user lease
+
+Revision ID: 2d9b6f4e8a15
+Revises: 8c4f2e6a1d57
+Create Date: 2026-10-18 20:31:47.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d9b6f4e8a15'
+down_revision = '8c4f2e6a1d57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('lease_owner', sa.String(length=100), nullable=True))
+    op.add_column('user', sa.Column('lease_expires', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'lease_expires')
+    op.drop_column('user', 'lease_owner')
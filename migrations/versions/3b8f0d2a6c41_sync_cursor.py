@@ -0,0 +1,24 @@
+"""sync cursor
+
+Revision ID: 3b8f0d2a6c41
+Revises: 9a1c3e5d7f20
+Create Date: 2026-10-18 14:03:17.560932
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8f0d2a6c41'
+down_revision = '9a1c3e5d7f20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('sync_cursor', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'sync_cursor')
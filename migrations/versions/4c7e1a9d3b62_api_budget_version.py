@@ -0,0 +1,24 @@
+"""api budget version
+
+Revision ID: 4c7e1a9d3b62
+Revises: 2d9b6f4e8a15
+Create Date: 2026-10-18 21:12:05.418337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c7e1a9d3b62'
+down_revision = '2d9b6f4e8a15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('api_budget', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('api_budget', 'version')
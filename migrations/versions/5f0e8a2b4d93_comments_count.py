@@ -0,0 +1,24 @@
+"""comments count
+
+Revision ID: 5f0e8a2b4d93
+Revises: a7d35f18c9e2
+Create Date: 2026-10-18 19:15:33.640287
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f0e8a2b4d93'
+down_revision = 'a7d35f18c9e2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('expense', sa.Column('comments_count', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('expense', 'comments_count')
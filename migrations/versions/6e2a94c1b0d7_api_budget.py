@@ -0,0 +1,30 @@
+"""api budget
+
+Revision ID: 6e2a94c1b0d7
+Revises: d41c7b9e2f63
+Create Date: 2026-10-18 16:40:02.871355
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2a94c1b0d7'
+down_revision = 'd41c7b9e2f63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('api_budget',
+        sa.Column('name', sa.String(length=40), nullable=False),
+        sa.Column('tokens', sa.Float(), nullable=False),
+        sa.Column('updated', sa.Float(), nullable=False),
+        sa.Column('blocked_until', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('api_budget')
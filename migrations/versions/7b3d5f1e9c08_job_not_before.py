@@ -0,0 +1,26 @@
+"""job not before and user backoff
+
+Revision ID: 7b3d5f1e9c08
+Revises: 4c7e1a9d3b62
+Create Date: 2026-10-18 22:04:41.207615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b3d5f1e9c08'
+down_revision = '4c7e1a9d3b62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('job', sa.Column('not_before', sa.DateTime(), nullable=True))
+    op.add_column('user', sa.Column('backoff_until', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'backoff_until')
+    op.drop_column('job', 'not_before')
@@ -0,0 +1,39 @@
+"""sync journal
+
+Revision ID: 8c4f2e6a1d57
+Revises: 5f0e8a2b4d93
+Create Date: 2026-10-18 20:10:12.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4f2e6a1d57'
+down_revision = '5f0e8a2b4d93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('sync_step',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('expense_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('state', sa.String(length=10), nullable=False),
+        sa.Column('currency', sa.String(length=3), nullable=False),
+        sa.Column('rate', sa.Float(), nullable=False),
+        sa.Column('original_value', sa.Float(), nullable=False),
+        sa.Column('original_currency', sa.String(length=3), nullable=False),
+        sa.Column('old_comment_id', sa.Integer(), nullable=True),
+        sa.Column('comment_id', sa.Integer(), nullable=True),
+        sa.Column('cursor', sa.DateTime(), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'expense_id')
+    )
+
+
+def downgrade():
+    op.drop_table('sync_step')
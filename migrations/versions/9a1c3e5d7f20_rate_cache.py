@@ -0,0 +1,30 @@
+"""rate cache
+
+Revision ID: 9a1c3e5d7f20
+Revises: 52e1408e28d4
+Create Date: 2026-10-18 10:12:41.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a1c3e5d7f20'
+down_revision = '52e1408e28d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rate',
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('base', sa.String(length=3), nullable=False),
+        sa.Column('symbol', sa.String(length=3), nullable=False),
+        sa.Column('rate', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('date', 'base', 'symbol')
+    )
+
+
+def downgrade():
+    op.drop_table('rate')
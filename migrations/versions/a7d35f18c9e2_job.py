@@ -0,0 +1,39 @@
+"""job queue
+
+Revision ID: a7d35f18c9e2
+Revises: 6e2a94c1b0d7
+Create Date: 2026-10-18 18:02:55.306174
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d35f18c9e2'
+down_revision = '6e2a94c1b0d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('state', sa.String(length=10), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=True),
+        sa.Column('converted', sa.Integer(), nullable=False),
+        sa.Column('failed', sa.Integer(), nullable=False),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_job_state', 'job', ['state'])
+
+
+def downgrade():
+    op.drop_index('ix_job_state', 'job')
+    op.drop_table('job')
@@ -0,0 +1,26 @@
+"""cache wrong expenses
+
+Revision ID: d41c7b9e2f63
+Revises: 3b8f0d2a6c41
+Create Date: 2026-10-18 15:21:49.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41c7b9e2f63'
+down_revision = '3b8f0d2a6c41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('wrong_cache', sa.Text(), nullable=True))
+    op.add_column('user', sa.Column('wrong_cached_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'wrong_cached_at')
+    op.drop_column('user', 'wrong_cache')
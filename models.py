@@ -1,15 +1,51 @@
 import datetime
 import humanize
-from requests_oauthlib import OAuth1Session
+import json
+from metrics import CACHE
+from multiprocessing.pool import ThreadPool
+from tracing import wrap
+from sessions import (authed_session, plain_session,
+                      SPLITWISE_API, RATES_API)
+from singleflight import SingleFlight
+from sqlalchemy.exc import IntegrityError
+
+
+def chunked(items, size=500):
+    # Keeps "IN (...)" queries under the bind parameter limits
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def get_expenses(api, url):
+    expenses = api.get(url)
+    expenses.raise_for_status()
+    return expenses.json()["expenses"]
 
 
 def build_models(db):
+    # (date, base) -> {symbol: rate}, shared by everything in this process
+    rate_cache = {}
+    # A day's rates being fetched for one base, which every symbol shares
+    rate_flights = SingleFlight("rates")
+
     class User(db.Model):
         id = db.Column(db.Integer, primary_key=True)
         splitwise_id = db.Column(db.Integer, unique=True)
         resource_owner_key = db.Column(db.String(40), unique=True)
         resource_owner_secret = db.Column(db.String(40), unique=True)
         last_update = db.Column(db.DateTime)
+        # Highest Splitwise updated_at seen by the last complete sync
+        sync_cursor = db.Column(db.DateTime, nullable=True)
+        # Last computed (currency, wrong expenses) for the index page
+        wrong_cache = db.Column(db.Text, nullable=True)
+        wrong_cached_at = db.Column(db.DateTime, nullable=True)
+        # Whoever is syncing this user, so no two processes do it at once
+        lease_owner = db.Column(db.String(100), nullable=True)
+        lease_expires = db.Column(db.DateTime, nullable=True)
+        # After a failed scheduled sync, when they're next due at the
+        # earliest. Doesn't stop anything else from syncing them.
+        backoff_until = db.Column(db.DateTime, nullable=True)
 
         def __init__(self, resource_owner_key, resource_owner_secret):
             self.resource_owner_key = resource_owner_key
@@ -21,28 +57,144 @@ def build_models(db):
             return humanize.naturaltime(
                 datetime.datetime.now() - self.last_update)
 
-        def update(self):
+        def update(self, cursor=None):
             self.last_update = datetime.datetime.now()
+            if cursor is not None and \
+                    (self.sync_cursor is None or cursor > self.sync_cursor):
+                self.sync_cursor = cursor
+
+        def cached_wrong(self, ttl):
+            if self.wrong_cache is None or self.wrong_cached_at is None:
+                return None
+            age = datetime.datetime.now() - self.wrong_cached_at
+            if age.total_seconds() > ttl:
+                return None
+            cached = json.loads(self.wrong_cache)
+            for expense in cached["wrong"]:
+                expense["when"] = datetime.datetime.strptime(
+                    expense["when"], "%Y-%m-%dT%H:%M:%SZ")
+            return cached["currency"], cached["wrong"]
+
+        def cache_wrong(self, currency, wrong):
+            wrong = [dict(expense) for expense in wrong]
+            for expense in wrong:
+                expense["when"] = expense["when"].strftime(
+                    "%Y-%m-%dT%H:%M:%SZ")
+            self.wrong_cache = json.dumps(
+                {"currency": currency, "wrong": wrong})
+            self.wrong_cached_at = datetime.datetime.now()
+
+        def invalidate_wrong(self):
+            self.wrong_cache = None
+            self.wrong_cached_at = None
 
         def __repr__(self):
             return '<User %r>' % self.splitwise_id
 
+        @staticmethod
+        def claim(id, owner, seconds):
+            # Conditional update, so only one process can hold it (or
+            # extend it, if it's already theirs)
+            now = datetime.datetime.now()
+            table = User.__table__
+            with db.engine.begin() as conn:
+                claimed = conn.execute(table.update().where(
+                    (table.c.id == id) &
+                    (table.c.lease_expires.is_(None) |
+                     (table.c.lease_expires < now) |
+                     (table.c.lease_owner == owner))).values(
+                        lease_owner=owner,
+                        lease_expires=now + datetime.timedelta(
+                            seconds=seconds))).rowcount
+            return claimed == 1
+
+        @staticmethod
+        def release(id, owner, backoff=None):
+            # backoff keeps the scheduler off them for a while (see due),
+            # 0 clears it and None leaves it as it was
+            values = {"lease_owner": None, "lease_expires": None}
+            if backoff is not None:
+                values["backoff_until"] = None
+                if backoff > 0:
+                    values["backoff_until"] = datetime.datetime.now() + \
+                        datetime.timedelta(seconds=backoff)
+            table = User.__table__
+            with db.engine.begin() as conn:
+                conn.execute(table.update().where(
+                    (table.c.id == id) &
+                    (table.c.lease_owner == owner)).values(**values))
+
+        @staticmethod
+        def due(interval, idle_interval, active_days, limit=20):
+            # Most overdue first. People with anything changed in the last
+            # active_days are due every interval, everyone else every
+            # idle_interval.
+            now = datetime.datetime.now()
+            # sync_cursor comes from Splitwise, so it's UTC, unlike the rest
+            active_since = datetime.datetime.utcnow() - \
+                datetime.timedelta(days=active_days)
+            rows = db.session.query(
+                User.id, User.last_update, User.sync_cursor).filter(
+                User.splitwise_id.isnot(None),
+                User.lease_expires.is_(None) | (User.lease_expires < now),
+                User.backoff_until.is_(None) | (User.backoff_until < now),
+                User.last_update.is_(None) |
+                (User.last_update <
+                 now - datetime.timedelta(seconds=interval))).all()
+            overdue = []
+            for (id, last_update, cursor) in rows:
+                if last_update is None:
+                    overdue.append((float("inf"), id))
+                    continue
+                if cursor is not None and cursor > active_since:
+                    period = interval
+                else:
+                    period = idle_interval
+                late = (now - last_update).total_seconds() - period
+                if late >= 0:
+                    overdue.append((late, id))
+            overdue.sort(key=lambda due: -due[0])
+            return [id for (_, id) in overdue[:limit]]
+
         def authed_api(self, client_key, client_secret):
-            return OAuth1Session(
-                client_key,
-                client_secret=client_secret,
-                resource_owner_key=self.resource_owner_key,
-                resource_owner_secret=self.resource_owner_secret)
-
-        def expenses_url(self):
-            url = "https://secure.splitwise.com/api/v3.0/get_expenses"
-            if self.last_update is None:
-                url += "?limit=0"
-            else:
-                url += "?updated_after=%s" % \
+            return authed_session(
+                client_key, client_secret,
+                self.resource_owner_key, self.resource_owner_secret)
+
+        def expenses_url(self, limit=0, offset=0):
+            url = SPLITWISE_API + "get_expenses" + \
+                "?limit=%d&offset=%d" % (limit, offset)
+            if self.sync_cursor is not None:
+                url += "&updated_after=%s" % \
+                    self.sync_cursor.strftime("%Y-%m-%dT%H:%M:%SZ")
+            elif self.last_update is not None:
+                # synced before we kept a cursor
+                url += "&updated_after=%s" % \
                     self.last_update.strftime("%Y-%m-%d")
             return url
 
+        def expense_pages(self, api, page_size):
+            # Yields pages as they arrive, while the next one is already
+            # being fetched in the background. URLs are built here rather
+            # than in the pool, as that mustn't touch the session.
+            pool = ThreadPool(1)
+            try:
+                offset = 0
+                pending = pool.apply_async(
+                    get_expenses, (api, self.expenses_url(page_size, offset)))
+                while True:
+                    page = pending.get()
+                    if len(page) < page_size:
+                        yield page
+                        return
+                    offset += page_size
+                    pending = pool.apply_async(
+                        get_expenses,
+                        (api, self.expenses_url(page_size, offset)))
+                    yield page
+            finally:
+                pool.close()
+
     class Expense(db.Model):
         id = db.Column(db.Integer, primary_key=True)
         last_update = db.Column(db.DateTime)
@@ -51,27 +203,343 @@ def build_models(db):
         updated_for = db.Column(db.Integer, nullable=False)
         comment_id = db.Column(db.Integer, nullable=True)
         original_rate = db.Column(db.Float, nullable=True)
+        # As of the last time we scanned its comments
+        comments_count = db.Column(db.Integer, nullable=True)
+
+        @staticmethod
+        def load_many(ids):
+            known = {}
+            for chunk in chunked(set(ids)):
+                for expense in Expense.query.filter(Expense.id.in_(chunk)):
+                    known[expense.id] = expense
+            return known
+
+    class Rate(db.Model):
+        date = db.Column(db.Date, primary_key=True)
+        base = db.Column(db.String(3), primary_key=True)
+        symbol = db.Column(db.String(3), primary_key=True)
+        rate = db.Column(db.Float, nullable=False)
+
+        # A ratesdb.RateTable, if we've got the rates on disk
+        offline = None
+
+        @staticmethod
+        def prefetch(days, base, workers=8):
+            table, to_fetch = Rate.lookup(days, base)
+            if len(to_fetch) == 0:
+                return table
+            pool = ThreadPool(min(workers, len(to_fetch)))
+            try:
+                fetched = pool.map(
+                    wrap(lambda day: Rate.fetch_rates(day, base)), to_fetch)
+            finally:
+                pool.close()
+            return Rate.remember(base, table, zip(to_fetch, fetched))
+
+        @staticmethod
+        def lookup(days, base):
+            # Whatever we've already got, and the days we'll need to fetch
+            table = {}
+            missing = []
+            offline = 0
+            for day in days:
+                if Rate.offline is not None:
+                    rates = Rate.offline.rates_for(day, base)
+                    if rates is not None:
+                        table[day] = rates
+                        offline += 1
+                        continue
+                if (day, base) in rate_cache:
+                    table[day] = rate_cache[(day, base)]
+                else:
+                    missing.append(day)
+            for chunk in chunked(missing):
+                rows = Rate.query.filter(
+                    Rate.base == base, Rate.date.in_(chunk)).all()
+                for row in rows:
+                    table.setdefault(row.date, {})[row.symbol] = row.rate
+            for day in missing:
+                if day in table:
+                    rate_cache[(day, base)] = table[day]
+
+            to_fetch = [day for day in missing if day not in table]
+            CACHE.inc(offline, cache="rates", result="offline")
+            CACHE.inc(len(days) - len(missing) - offline,
+                      cache="rates", result="memory")
+            CACHE.inc(len(missing) - len(to_fetch),
+                      cache="rates", result="db")
+            CACHE.inc(len(to_fetch), cache="rates", result="miss")
+            return table, to_fetch
+
+        @staticmethod
+        def remember(base, table, fetched):
+            today = datetime.date.today()
+            to_store = {}
+            for day, rates in fetched:
+                table[day] = rates
+                # today's rates can still change, so don't keep them
+                if day < today:
+                    to_store[day] = rates
+                    rate_cache[(day, base)] = rates
+            Rate.store_rates(base, to_store)
+            return table
+
+        @staticmethod
+        def rates_url(day, base):
+            return RATES_API + "%s?base=%s" % (day.strftime("%Y-%m-%d"), base)
 
         @staticmethod
-        def get_comments(api, id):
-            url = "https://secure.splitwise.com/api/v3.0/" + \
-                  "get_comments?expense_id=%d" % id
-            comments = api.get(url)
-            comments.raise_for_status()
-            return comments.json()["comments"]
+        def parse_rates(data, base):
+            rates = data["rates"]
+            # fixer never includes the base, and having it stored also marks
+            # the day as fetched for symbols it doesn't know about
+            rates[base] = 1.0
+            return rates
+
+        @staticmethod
+        def fetch_rates(day, base):
+            return rate_flights.do(
+                (day, base), lambda: Rate.request_rates(day, base))
+
+        @staticmethod
+        def request_rates(day, base):
+            rates = plain_session().get(Rate.rates_url(day, base))
+            rates.raise_for_status()
+            return Rate.parse_rates(rates.json(), base)
+
+        @staticmethod
+        def store_rates(base, days):
+            rows = [
+                {"date": day, "base": base, "symbol": symbol, "rate": rate}
+                for (day, rates) in days.items()
+                for (symbol, rate) in rates.items()]
+            if len(rows) == 0:
+                return
+            # Separate transaction so we don't commit/rollback anything
+            # pending in the session
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(Rate.__table__.insert(), rows)
+            except IntegrityError:
+                # Someone else (another worker?) stored some of these first,
+                # so just add the days that are still missing
+                if len(days) > 1:
+                    for day, rates in days.items():
+                        Rate.store_rates(base, {day: rates})
+
+    class ApiBudget(db.Model):
+        name = db.Column(db.String(40), primary_key=True)
+        tokens = db.Column(db.Float, nullable=False)
+        updated = db.Column(db.Float, nullable=False)
+        blocked_until = db.Column(db.Float, nullable=False)
+        # Bumped by every update, which only goes ahead if it's unchanged
+        version = db.Column(db.Integer, nullable=False, server_default="0")
+
+    class Job(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        user_id = db.Column(
+            db.Integer, db.ForeignKey('user.id'), nullable=False)
+        # queued -> running -> done/failed
+        state = db.Column(db.String(10), nullable=False)
+        total = db.Column(db.Integer, nullable=True)
+        converted = db.Column(db.Integer, nullable=False, default=0)
+        failed = db.Column(db.Integer, nullable=False, default=0)
+        error = db.Column(db.Text, nullable=True)
+        created_at = db.Column(db.DateTime, nullable=False)
+        started_at = db.Column(db.DateTime, nullable=True)
+        finished_at = db.Column(db.DateTime, nullable=True)
+        # Put off after finding someone else syncing the user
+        not_before = db.Column(db.DateTime, nullable=True)
+
+        user = db.relationship(User)
+
+        def __init__(self, user):
+            self.user = user
+            self.state = "queued"
+            self.converted = 0
+            self.failed = 0
+            self.created_at = datetime.datetime.now()
+
+        @staticmethod
+        def enqueue(user):
+            # Don't pile up jobs for someone who keeps pressing the button
+            recent = datetime.datetime.now() - datetime.timedelta(hours=1)
+            existing = Job.query.filter(
+                Job.user_id == user.id,
+                (Job.state == "queued") |
+                ((Job.state == "running") & (Job.started_at > recent))
+            ).first()
+            if existing is not None:
+                return existing
+            job = Job(user)
+            db.session.add(job)
+            db.session.commit()
+            return job
+
+        @staticmethod
+        def latest(user):
+            return Job.query.filter_by(user_id=user.id).order_by(
+                Job.id.desc()).first()
+
+        @staticmethod
+        def claim_next(stale_after):
+            # Several workers can race for a job, but the conditional
+            # update means only one of them gets it. Jobs for users who are
+            # being synced elsewhere wait, rather than holding up the rest.
+            now = datetime.datetime.now()
+            Job.fail_abandoned(now, stale_after)
+            queued = Job.query.join(User).filter(
+                Job.state == "queued",
+                Job.not_before.is_(None) | (Job.not_before <= now),
+                User.lease_expires.is_(None) | (User.lease_expires < now)
+            ).order_by(Job.id).limit(10).all()
+            for job in queued:
+                claimed = Job.query.filter_by(
+                    id=job.id, state="queued").update({
+                        "state": "running",
+                        "started_at": datetime.datetime.now()},
+                    synchronize_session=False)
+                db.session.commit()
+                if claimed == 1:
+                    return Job.query.get(job.id)
+            return None
+
+        @staticmethod
+        def fail_abandoned(now, stale_after):
+            # A worker that died part way through leaves its job running,
+            # but its lease on the user runs out
+            abandoned = [id for (id,) in db.session.query(Job.id).join(
+                User).filter(
+                Job.state == "running",
+                Job.started_at <
+                now - datetime.timedelta(seconds=stale_after),
+                User.lease_expires.is_(None) | (User.lease_expires < now))]
+            if len(abandoned) == 0:
+                return
+            Job.query.filter(
+                Job.id.in_(abandoned), Job.state == "running").update({
+                    "state": "failed",
+                    "error": "Abandoned by its worker",
+                    "finished_at": now},
+                synchronize_session=False)
+            db.session.commit()
+
+        def requeue(self, delay):
+            # Someone else is syncing the user, so try again later
+            self.state = "queued"
+            self.started_at = None
+            self.not_before = datetime.datetime.now() + datetime.timedelta(
+                seconds=delay)
+
+        def progress(self, converted, total, failed):
+            # Own transaction, so it's visible while the sync is going
+            with db.engine.begin() as conn:
+                conn.execute(Job.__table__.update().where(
+                    Job.__table__.c.id == self.id).values(
+                        converted=converted, total=total, failed=failed))
+
+        def finish(self, error=None):
+            if error is None:
+                self.state = "done"
+            else:
+                self.state = "failed"
+                self.error = error
+            self.finished_at = datetime.datetime.now()
+
+        def status(self):
+            return {
+                "id": self.id,
+                "state": self.state,
+                "total": self.total,
+                "converted": self.converted,
+                "failed": self.failed,
+                "error": self.error}
+
+    class SyncStep(db.Model):
+        # Journal of the expenses a sync is converting, written before and
+        # after each Splitwise write, so a sync that dies part way through
+        # can carry on without redoing (or double applying) anything
+        user_id = db.Column(
+            db.Integer, db.ForeignKey('user.id'), primary_key=True)
+        expense_id = db.Column(
+            db.Integer, primary_key=True, autoincrement=False)
+        # planned -> commenting -> updating -> (updated ->) done, each
+        # written before the Splitwise call it's named for
+        state = db.Column(db.String(10), nullable=False)
+        currency = db.Column(db.String(3), nullable=False)
+        rate = db.Column(db.Float, nullable=False)
+        original_value = db.Column(db.Float, nullable=False)
+        original_currency = db.Column(db.String(3), nullable=False)
+        old_comment_id = db.Column(db.Integer, nullable=True)
+        comment_id = db.Column(db.Integer, nullable=True)
+        # The cursor for the sync that planned this
+        cursor = db.Column(db.DateTime, nullable=True)
+        attempts = db.Column(db.Integer, nullable=False)
+        changed_at = db.Column(db.DateTime, nullable=False)
+
+        @staticmethod
+        def plan(user, currency, cursor, conversions):
+            # conversions: (expense id, rate, original value, original
+            # currency, comment id) for everything about to be converted
+            now = datetime.datetime.now()
+            steps = [
+                SyncStep(
+                    user_id=user.id, expense_id=id, state="planned",
+                    currency=currency, rate=rate, original_value=value,
+                    original_currency=original_currency,
+                    old_comment_id=comment_id, cursor=cursor, attempts=0,
+                    changed_at=now)
+                for (id, rate, value, original_currency, comment_id)
+                in conversions]
+            table = SyncStep.__table__
+            with db.engine.begin() as conn:
+                for chunk in chunked(steps):
+                    conn.execute(table.insert(), [
+                        dict((column.name, getattr(step, column.name))
+                             for column in table.columns)
+                        for step in chunk])
+            return steps
+
+        @staticmethod
+        def resume(user):
+            # Whatever a previous sync of this user didn't finish
+            steps = SyncStep.query.filter_by(user_id=user.id).order_by(
+                SyncStep.expense_id).all()
+            for step in steps:
+                db.session.expunge(step)
+            return steps
+
+        def advance(self, state, **values):
+            # Own transaction, so it's there even if the sync then dies
+            values["state"] = state
+            values["changed_at"] = datetime.datetime.now()
+            for key, value in values.items():
+                setattr(self, key, value)
+            table = SyncStep.__table__
+            with db.engine.begin() as conn:
+                conn.execute(table.update().where(
+                    (table.c.user_id == self.user_id) &
+                    (table.c.expense_id == self.expense_id)).values(
+                        **values))
 
-        def add_comment(self, api, text):
-            new_c = {"content": text, "expense_id": self.id}
-            url = "https://secure.splitwise.com/api/v3.0/create_comment"
-            add = api.post(url, data=new_c)
-            add.raise_for_status()
-            return add.json()
+        def fail(self):
+            # Only for the step that went wrong, not the ones after it that
+            # never got a go
+            self.attempts += 1
+            table = SyncStep.__table__
+            with db.engine.begin() as conn:
+                conn.execute(table.update().where(
+                    (table.c.user_id == self.user_id) &
+                    (table.c.expense_id == self.expense_id)).values(
+                        attempts=table.c.attempts + 1))
 
         @staticmethod
-        def delete_comment(api, id):
-            url = "https://secure.splitwise.com/api/v3.0/" + \
-                "delete_comment/%d" % id
-            add = api.post(url)
-            add.raise_for_status()
+        def clear(user):
+            table = SyncStep.__table__
+            with db.engine.begin() as conn:
+                conn.execute(table.delete().where(
+                    table.c.user_id == user.id))
 
-    return {"User": User, "Expense": Expense}
+    return {
+        "User": User, "Expense": Expense, "Rate": Rate,
+        "ApiBudget": ApiBudget, "Job": Job, "SyncStep": SyncStep}
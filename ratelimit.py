@@ -0,0 +1,103 @@
+import email.utils
+import time
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+
+class TokenBucket(object):
+    # Token bucket kept in a database row, so every worker and CLI process
+    # shares the same budget. Updates are conditional on the row's version
+    # not having changed since we read it, which works the same on Postgres
+    # and SQLite. (Not on the float timestamps, which needn't come back
+    # from the DB exactly as they went in.)
+
+    def __init__(self, engine, table, name, rate, capacity):
+        self.engine = engine
+        self.table = table
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+
+    def _read(self, conn):
+        query = select([self.table]).where(self.table.c.name == self.name)
+        row = conn.execute(query).first()
+        if row is None:
+            try:
+                conn.execute(self.table.insert().values(
+                    name=self.name, tokens=self.capacity,
+                    updated=time.time(), blocked_until=0.0, version=0))
+            except IntegrityError:
+                # another process created it first
+                pass
+            row = conn.execute(query).first()
+        return row
+
+    def _take(self):
+        # Returns how long to wait before trying again, or 0 if we got one
+        with self.engine.connect() as conn:
+            row = self._read(conn)
+            now = time.time()
+            if row.blocked_until > now:
+                return row.blocked_until - now
+            tokens = min(
+                self.capacity,
+                row.tokens + (now - row.updated) * self.rate)
+            if tokens >= 1:
+                wait = 0.0
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            changed = conn.execute(self.table.update().where(
+                (self.table.c.name == self.name) &
+                (self.table.c.version == row.version)).values(
+                    tokens=tokens, updated=now,
+                    version=row.version + 1)).rowcount
+            if changed == 0:
+                # someone else got in first, so just try again
+                return 0.01
+            return wait
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    def block(self, seconds):
+        # Everyone backs off, e.g. after a 429
+        until = time.time() + seconds
+        with self.engine.connect() as conn:
+            self._read(conn)
+            conn.execute(self.table.update().where(
+                (self.table.c.name == self.name) &
+                (self.table.c.blocked_until < until)).values(
+                    blocked_until=until, tokens=0.0, updated=time.time(),
+                    version=self.table.c.version + 1))
+
+    def budget(self):
+        with self.engine.connect() as conn:
+            row = self._read(conn)
+        now = time.time()
+        tokens = min(
+            self.capacity, row.tokens + (now - row.updated) * self.rate)
+        blocked = max(0.0, row.blocked_until - now)
+        return {
+            "name": self.name,
+            "tokens": tokens,
+            "capacity": self.capacity,
+            "rate": self.rate,
+            "blocked_for": blocked}
+
+
+def retry_after(response, default=5.0):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        when = email.utils.parsedate_tz(value)
+        if when is None:
+            return default
+        return max(0.0, email.utils.mktime_tz(when) - time.time())
@@ -0,0 +1,157 @@
+import csv
+import datetime
+import io
+import zipfile
+from array import array
+
+# Historical rates from the ECB's eurofxref CSVs (the same data fixer.io
+# served), kept in memory as one array of EUR rates per currency. Every
+# calendar day maps straight to the row in force that day (weekends and
+# holidays use the last published rates), so lookups are O(1).
+
+MISSING = float("nan")
+
+
+def parse_day(value):
+    value = value.strip()
+    for fmt in ("%Y-%m-%d", "%d %B %Y"):
+        try:
+            return datetime.datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError("Unknown date %r" % value)
+
+
+def read_rows(path):
+    # eurofxref-hist.csv, the daily eurofxref.csv, or either zipped
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            name = [n for n in archive.namelist() if n.endswith(".csv")][0]
+            text = archive.read(name).decode("utf-8")
+    else:
+        with open(path, "rb") as f:
+            text = f.read().decode("utf-8")
+    reader = csv.reader(io.StringIO(text))
+    header = [column.strip() for column in next(reader)]
+    currencies = [column for column in header[1:] if column != ""]
+    rows = []
+    for row in reader:
+        if len(row) == 0 or row[0].strip() == "":
+            continue
+        rates = {}
+        for currency, value in zip(currencies, row[1:]):
+            value = value.strip()
+            if value not in ("", "N/A"):
+                rates[currency] = float(value)
+        rows.append((parse_day(row[0]), rates))
+    return rows
+
+
+class DayRates(object):
+    # What fixer returned for one day: units of each currency per `base`,
+    # worked out when asked for
+
+    def __init__(self, table, row, base):
+        self.table = table
+        self.row = row
+        self.base = self.table.eur_rate(row, base)
+
+    def __contains__(self, symbol):
+        return self.table.eur_rate(self.row, symbol) is not None
+
+    def __getitem__(self, symbol):
+        rate = self.table.eur_rate(self.row, symbol)
+        if rate is None:
+            raise KeyError(symbol)
+        return rate / self.base
+
+
+class RateTable(object):
+    def __init__(self):
+        self.days = []
+        self.currencies = {"EUR": None}
+        self.columns = []
+        # calendar day (from first_day) -> row in force
+        self.first_day = None
+        self.day_rows = array("i")
+
+    @staticmethod
+    def load(path):
+        table = RateTable()
+        table.append_file(path)
+        return table
+
+    def append_file(self, path):
+        # Only adds days after the ones we've already got
+        added = 0
+        for day, rates in sorted(read_rows(path), key=lambda r: r[0]):
+            if len(self.days) == 0 or day > self.days[-1]:
+                self.append_day(day, rates)
+                added += 1
+        return added
+
+    def append_day(self, day, rates):
+        if len(self.days) > 0 and day <= self.days[-1]:
+            raise ValueError("%s is not after %s" % (day, self.days[-1]))
+        row = len(self.days)
+        self.days.append(day)
+        for column in self.columns:
+            column.append(MISSING)
+        for currency, rate in rates.items():
+            if currency not in self.currencies:
+                self.currencies[currency] = len(self.columns)
+                self.columns.append(array("d", [MISSING] * (row + 1)))
+            self.columns[self.currencies[currency]][row] = rate
+        if self.first_day is None:
+            self.first_day = day
+            self.day_rows.append(row)
+        else:
+            previous = self.days[row - 1]
+            for _ in range((day - previous).days - 1):
+                self.day_rows.append(row - 1)
+            self.day_rows.append(row)
+
+    def row_for(self, day):
+        if self.first_day is None or day < self.first_day:
+            return None
+        offset = (day - self.first_day).days
+        if offset >= len(self.day_rows):
+            # Not published yet (or we're out of date)
+            return None
+        return self.day_rows[offset]
+
+    def eur_rate(self, row, currency):
+        if currency not in self.currencies:
+            return None
+        column = self.currencies[currency]
+        if column is None:
+            return 1.0
+        rate = self.columns[column][row]
+        if rate != rate:
+            # NaN, so not published that day
+            return None
+        return rate
+
+    def rates_for(self, day, base):
+        row = self.row_for(day)
+        if row is None or self.eur_rate(row, base) is None:
+            return None
+        return DayRates(self, row, base)
+
+    def write(self, path):
+        # Back out in eurofxref-hist.csv form, newest first
+        currencies = sorted(
+            (column, currency)
+            for (currency, column) in self.currencies.items()
+            if column is not None)
+        with open(path, "w") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(
+                ["Date"] + [currency for (_, currency) in currencies])
+            for row in range(len(self.days) - 1, -1, -1):
+                values = []
+                for (column, _) in currencies:
+                    rate = self.columns[column][row]
+                    values.append("N/A" if rate != rate else repr(rate))
+                writer.writerow(
+                    [self.days[row].strftime("%Y-%m-%d")] + values)
@@ -0,0 +1,148 @@
+import os
+import re
+import threading
+import time
+import requests
+from collections import OrderedDict
+from metrics import API_CALLS, API_LATENCY, CACHE
+from ratelimit import retry_after
+from tracing import span
+from requests.compat import urlparse
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1Session
+from urllib3.util.retry import Retry
+
+# Overridable so we can point at local stand-ins (see bench/)
+SPLITWISE_API = os.environ.get(
+    "SPLITWISE_API", "https://secure.splitwise.com/api/v3.0/")
+RATES_API = os.environ.get("RATES_API", "http://api.fixer.io/")
+
+# Enough connections for the comment/rate thread pools to share one session
+POOL_SIZE = 16
+RETRIES = 3
+# Times to wait out a 429 before giving up on a call
+RATE_LIMITED_RETRIES = 5
+# Users whose sessions (and their keep-alive sockets) we hang on to
+SESSION_CACHE_SIZE = 32
+
+_lock = threading.Lock()
+# resource_owner_key -> (resource_owner_secret, session), least recently
+# used first
+_sessions = OrderedDict()
+_plain = []
+_limiter = []
+
+
+def set_limiter(limiter):
+    del _limiter[:]
+    if limiter is not None:
+        _limiter.append(limiter)
+
+
+def get_limiter():
+    if len(_limiter) == 0:
+        return None
+    return _limiter[0]
+
+
+def endpoint(url):
+    path = urlparse(url).path.split("/api/v3.0/")[-1].lstrip("/")
+    return re.sub(r"[\d-]+(?=/|$)", "<id>", path)
+
+
+def timed(service, request, method, url, *args, **kwargs):
+    labels = {"service": service, "endpoint": endpoint(url)}
+    status = "error"
+    try:
+        with API_LATENCY.time(**labels), \
+                span("http", method=method, **labels):
+            response = request(method, url, *args, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        API_CALLS.inc(status=status, **labels)
+
+
+class TimedSession(requests.Session):
+    def request(self, method, url, *args, **kwargs):
+        return timed(
+            "rates", super(TimedSession, self).request,
+            method, url, *args, **kwargs)
+
+
+class LimitedSession(OAuth1Session):
+    # Every Splitwise call goes through the shared limiter, and waits out
+    # (and tells everyone else about) any 429 we get anyway
+
+    def request(self, method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            limiter = get_limiter()
+            if limiter is not None:
+                limiter.acquire()
+            response = timed(
+                "splitwise", super(LimitedSession, self).request,
+                method, url, *args, **kwargs)
+            if response.status_code != 429 or \
+                    attempt >= RATE_LIMITED_RETRIES:
+                return response
+            attempt += 1
+            wait = retry_after(response)
+            if limiter is not None:
+                limiter.block(wait)
+            else:
+                time.sleep(wait)
+
+
+def _mount(session):
+    # Retries connection failures and 5xx responses, with backoff. POSTs
+    # (e.g. create_comment) are only retried if they never got sent.
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False)
+    adapter = HTTPAdapter(
+        pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+        max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def authed_session(client_key, client_secret,
+                   resource_owner_key, resource_owner_secret):
+    with _lock:
+        existing = _sessions.pop(resource_owner_key, None)
+        if existing is not None and existing[0] == resource_owner_secret:
+            CACHE.inc(cache="session", result="hit")
+            _sessions[resource_owner_key] = existing
+            return existing[1]
+        CACHE.inc(cache="session", result="miss")
+        if existing is not None:
+            existing[1].close()
+        session = _mount(LimitedSession(
+            client_key,
+            client_secret=client_secret,
+            resource_owner_key=resource_owner_key,
+            resource_owner_secret=resource_owner_secret))
+        _sessions[resource_owner_key] = (resource_owner_secret, session)
+        while len(_sessions) > SESSION_CACHE_SIZE:
+            _, (_, evicted) = _sessions.popitem(last=False)
+            evicted.close()
+        return session
+
+
+def forget_session(resource_owner_key):
+    # For when a user re-authorises, and their old key is no more use
+    with _lock:
+        existing = _sessions.pop(resource_owner_key, None)
+    if existing is not None:
+        existing[1].close()
+
+
+def plain_session():
+    with _lock:
+        if len(_plain) == 0:
+            _plain.append(_mount(TimedSession()))
+        return _plain[0]
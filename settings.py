@@ -0,0 +1,30 @@
+import logging
+import os
+import yaml
+
+# Shared by the web app (fixer.py) and the sync (sync.py)
+
+if "DYNO" in os.environ:
+    logging.getLogger(__name__).info(
+        "Found DYNO environment variable, so assuming we're in Heroku")
+    config = {
+        "app": {
+            "database_uri": os.environ["DATABASE_URL"]
+        },
+        "splitwise": {
+            "client_id": os.environ["CLIENT_ID"],
+            "client_secret": os.environ["CLIENT_SECRET"]
+        },
+        "flask": {
+            "secret_key": os.environ["FLASK_ENCRYPTION_KEY"]
+        }
+    }
+else:
+    config = yaml.safe_load(open('config.yaml', 'r'))
+
+
+def app_setting(name, default):
+    value = config["app"].get(name, os.environ.get(name.upper()))
+    if value is None:
+        return default
+    return type(default)(value)
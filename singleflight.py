@@ -0,0 +1,45 @@
+import threading
+from metrics import COALESCED
+
+# Concurrent callers asking for the same thing (the same day's rates, the
+# same user's profile) share one call and its result, rather than each
+# making their own. Nothing is kept once the call is done; that's what
+# the caches are for.
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+        if not leader:
+            COALESCED.inc(flight=self.name)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
@@ -0,0 +1,889 @@
+from __future__ import print_function
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import argparse
+import json
+import logging
+import os
+import re
+import socket
+import sys
+import time
+
+from conversion import convert_expense, convert_values, from_minor, to_minor
+import metrics
+from metrics import (CACHE, EXPENSES_CONVERTED, EXPENSES_SCANNED,
+                     SYNC_DURATION)
+from models import build_models
+from ratelimit import TokenBucket
+from sessions import set_limiter, SPLITWISE_API
+from settings import config, app_setting
+from singleflight import SingleFlight
+from sqlalchemy import exc, text
+import tracing
+from tracing import span, maybe_trace
+from unitofwork import UnitOfWork
+
+# The sync engine, used by the web app (fixer.py) and on its own by
+# `python sync.py`, which doesn't need Flask at all
+
+logger = logging.getLogger(__name__)
+
+# Filled in by setup(), with either the web app's Flask-SQLAlchemy or a
+# plain database.Database
+db = None
+limiter = None
+User = Expense = Rate = ApiBudget = Job = SyncStep = None
+
+current_user_flights = SingleFlight("current_user")
+
+
+def setup(database):
+    global db, limiter, User, Expense, Rate, ApiBudget, Job, SyncStep
+    db = database
+    models = build_models(db)
+    User = models["User"]
+    Expense = models["Expense"]
+    Rate = models["Rate"]
+    ApiBudget = models["ApiBudget"]
+    Job = models["Job"]
+    SyncStep = models["SyncStep"]
+
+    if app_setting("splitwise_rate", 5.0) > 0:
+        limiter = TokenBucket(
+            db.engine, ApiBudget.__table__, "splitwise",
+            app_setting("splitwise_rate", 5.0),
+            app_setting("splitwise_burst", 20.0))
+    else:
+        limiter = None
+    set_limiter(limiter)
+
+    if app_setting("rates_file", "") != "":
+        from ratesdb import RateTable
+        Rate.offline = RateTable.load(app_setting("rates_file", ""))
+
+    tracing.trace_engine(db.engine)
+    return models
+
+
+def migration_head():
+    # Rather than import all of alembic just for this
+    directory = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "migrations", "versions")
+    revisions = set()
+    parents = set()
+    for name in os.listdir(directory):
+        if not name.endswith(".py"):
+            continue
+        with open(os.path.join(directory, name)) as f:
+            script = f.read()
+        revisions.add(re.search(
+            r"^revision = '(\w+)'", script, re.MULTILINE).group(1))
+        parents.update(re.findall(
+            r"'(\w+)'", re.search(
+                r"^down_revision = (.*)$", script, re.MULTILINE).group(1)))
+    heads = revisions - parents
+    if len(heads) != 1:
+        raise RuntimeError("Expected one migration head, not %r" % heads)
+    return heads.pop()
+
+
+def check_schema():
+    # Migrations are run by the release phase (--migrate), not here. This
+    # just makes sure that's happened, in one query.
+    head = migration_head()
+    try:
+        with db.engine.connect() as conn:
+            current = conn.execute(
+                text("SELECT version_num FROM alembic_version")).scalar()
+    except exc.DBAPIError:
+        current = None
+    if current != head:
+        raise RuntimeError(
+            "Database is at revision %s, but the code needs %s. "
+            "Run 'python fixer.py --migrate' first." % (current, head))
+
+
+class Call(object):
+    # One Splitwise request. The steps of a sync yield these rather than
+    # making the requests themselves, so the same steps can be run with
+    # requests (run_calls here) or aiohttp (aiosync.py).
+
+    def __init__(self, method, url, data=None):
+        self.method = method
+        self.url = url
+        self.data = data
+
+    def __repr__(self):
+        return "<Call %s %s>" % (self.method, self.url)
+
+
+def blocking(api, call):
+    response = getattr(api, call.method.lower())(call.url, data=call.data)
+    response.raise_for_status()
+    return response.json()
+
+
+def run_calls(api, calls):
+    # Sends each call's JSON back into the generator that asked for it
+    try:
+        call = next(calls)
+        while True:
+            call = calls.send(blocking(api, call))
+    except StopIteration:
+        pass
+    finally:
+        calls.close()
+
+
+def current_user_call():
+    return Call("GET", SPLITWISE_API + "get_current_user")
+
+
+def comments_call(id):
+    return Call("GET", SPLITWISE_API + "get_comments?expense_id=%d" % id)
+
+
+def default_currency(data):
+    currency = data["user"]["default_currency"]
+    if currency is None:
+        currency = "GBP"
+    return currency
+
+
+def get_default_currency(api):
+    # There's one session per user (see sessions.authed_session), so this
+    # is one request per user however many threads want it
+    return default_currency(current_user_flights.do(
+        api, lambda: blocking(api, current_user_call())))
+
+
+def fetch_comments(api, ids):
+    ids = list(ids)
+    if len(ids) == 0:
+        return {}
+    pool = ThreadPool(min(app_setting("comment_workers", 8), len(ids)))
+    try:
+        comments = pool.map(
+            tracing.wrap(lambda id: blocking(api, comments_call(id))), ids)
+    finally:
+        pool.close()
+    return dict(zip(ids, [c["comments"] for c in comments]))
+
+
+def wrong_expenses(api, existing, currency):
+    uow = unit_of_work()
+    wrong = scan_expenses(api, existing, currency, uow)[0]
+    uow.flush()
+    return wrong
+
+
+def unit_of_work():
+    return UnitOfWork(db.session, Expense, app_setting("write_chunk", 200))
+
+
+def scan_expenses(api, existing, currency, uow):
+    with span("wrong_expenses"):
+        return scan_expenses_traced(api, existing, currency, uow)
+
+
+def scan_expenses_traced(api, existing, currency, uow):
+    # Also returns the newest updated_at seen, to use as the sync cursor,
+    # and the payloads of the wrong expenses so they needn't be re-fetched
+    wrong = []
+    cursor = None
+    snapshot = {}
+    page_size = expenses_page_size()
+    for expenses in existing.expense_pages(api, page_size):
+        EXPENSES_SCANNED.inc(len(expenses))
+        with span("page", expenses=len(expenses)):
+            wrong.extend(wrong_expenses_page(
+                api, expenses, currency, uow, snapshot))
+        cursor = page_cursor(expenses, cursor)
+    return wrong, cursor, snapshot
+
+
+def expenses_page_size():
+    # 0 would be "all of them" to Splitwise, and the paging would never end
+    size = app_setting("expenses_page_size", 100)
+    if size < 1:
+        raise ValueError(
+            "expenses_page_size must be at least 1, not %d" % size)
+    return size
+
+
+def page_cursor(expenses, cursor):
+    for expense in expenses:
+        when = datetime.strptime(
+            expense["updated_at"], "%Y-%m-%dT%H:%M:%SZ")
+        if cursor is None or when > cursor:
+            cursor = when
+    return cursor
+
+
+def wrong_expenses_page(api, expenses, currency, uow, snapshot=None):
+    known = uow.load(expense["id"] for expense in expenses)
+    changed, to_scan = comments_to_scan(expenses, known)
+    # Fetch all the comments at once, and only then touch the DB
+    with span("comments", expenses=len(to_scan)):
+        all_comments = fetch_comments(api, to_scan)
+    read_comments(changed, all_comments, known, uow)
+
+    to_convert = find_conversions(expenses, currency, known)
+    # Resolve every rate we need up front rather than one at a time
+    with span("rates", expenses=len(to_convert)):
+        rates = Rate.prefetch(conversion_days(to_convert), currency)
+    return price_conversions(to_convert, currency, rates, snapshot)
+
+
+def comments_to_scan(expenses, known):
+    changed = []
+    for expense in expenses:
+        if expense["comments_count"] > 0:
+            expense_obj = known.get(expense["id"])
+            when = datetime.strptime(
+                expense["updated_at"], "%Y-%m-%dT%H:%M:%SZ")
+            if expense_obj is None \
+                    or expense_obj.last_update is None \
+                    or when > expense_obj.last_update:
+                changed.append((expense, when))
+
+    # Comments can't be edited, so if there's the same number as last time
+    # (and update_expense keeps us in step with our own) they're the same
+    # ones and don't need scanning again
+    to_scan = [
+        expense["id"] for (expense, _) in changed
+        if known.get(expense["id"]) is None
+        or known[expense["id"]].comments_count != expense["comments_count"]]
+
+    CACHE.inc(len(changed) - len(to_scan), cache="comments", result="hit")
+    CACHE.inc(len(to_scan), cache="comments", result="miss")
+    return changed, to_scan
+
+
+def read_comments(changed, all_comments, known, uow):
+    for (expense, when) in changed:
+        expense_obj = known.get(expense["id"])
+        if expense["id"] not in all_comments:
+            expense_obj.last_update = when
+            uow.update(expense_obj)
+            continue
+        comments = all_comments[expense["id"]]
+        info = None
+        is_new = expense_obj is None
+        if is_new:
+            expense_obj = Expense(
+                id=expense["id"],
+                last_update=when,
+                original_currency=expense["currency_code"],
+                original_value=float(expense["cost"]),
+                updated_for=expense["id"])
+            known[expense_obj.id] = expense_obj
+        else:
+            expense_obj.last_update = when
+        expense_obj.comments_count = expense["comments_count"]
+        comment_id = None
+        for comment in comments[::-1]:
+            if comment["deleted_at"] is not None:
+                continue
+            if not comment["content"].lstrip().startswith("{"):
+                # can't be one of ours
+                continue
+            try:
+                info = json.loads(comment["content"])
+                comment_id = comment["id"]
+            except ValueError:
+                pass
+        if info is not None:
+            expense_obj.comment_id = comment_id
+            expense_obj.updated_for = info["updated_for"]
+            expense_obj.original_currency = info["original_currency"]
+            expense_obj.original_value = info["original_value"]
+            expense_obj.original_rate = info["conversion_rate"]
+        if is_new:
+            uow.insert(expense_obj)
+        else:
+            uow.update(expense_obj)
+
+
+def find_conversions(expenses, currency, known):
+    to_convert = []
+    for expense in expenses:
+        expense_obj = known.get(expense["id"])
+        if expense_obj is None:
+            currency_code = expense['currency_code']
+            original = float(expense["cost"])
+        else:
+            currency_code = expense_obj.original_currency
+            original = expense_obj.original_value
+        if expense['currency_code'] != currency or \
+                (expense_obj is not None and
+                    expense_obj.updated_for != expense['id']):
+            when = datetime.strptime(
+                expense["created_at"], "%Y-%m-%dT%H:%M:%SZ")
+            to_convert.append((expense, when, currency_code, original))
+    return to_convert
+
+
+def conversion_days(to_convert):
+    return set(when.date() for (_, when, _, _) in to_convert)
+
+
+def price_conversions(to_convert, currency, rates, snapshot=None):
+    wrong = []
+    convert = []
+    for (expense, when, currency_code, original) in to_convert:
+        day_rates = rates[when.date()]
+        if currency_code in day_rates:
+            convert.append(day_rates[currency_code])
+        else:
+            convert.append(None)
+    # Same rounding as update_expense will use, all in one go
+    converted = iter(convert_values(
+        [original for ((_, _, _, original), rate) in zip(to_convert, convert)
+         if rate is not None],
+        [rate for rate in convert if rate is not None]))
+
+    for ((expense, when, currency_code, original), rate) in zip(
+            to_convert, convert):
+        if rate is None:
+            to_value = "Can't convert %s" % currency_code
+        else:
+            to_value = float(next(converted))
+        if snapshot is not None:
+            snapshot[expense["id"]] = snapshot_fields(expense)
+        wrong.append({
+            "id": expense["id"],
+            "description": expense["description"],
+            "when": when,
+            "from_value": str(original),
+            "from_currency": currency_code,
+            "to_currency": currency,
+            "to_value": to_value,
+            "rate": rate})
+    return wrong
+
+
+def snapshot_fields(expense):
+    # Just what update_expense_calls needs, so a long scan doesn't hold on
+    # to every wrong expense's whole payload
+    return {
+        "cost": expense["cost"],
+        "currency_code": expense["currency_code"],
+        "updated_at": expense["updated_at"],
+        "comments_count": expense["comments_count"],
+        "users": [{
+            "user_id": user["user_id"],
+            "paid_share": user["paid_share"],
+            "owed_share": user["owed_share"]}
+            for user in expense["users"]]}
+
+
+def snapshot_stale(expense, expense_obj):
+    if expense is None or "users" not in expense:
+        return True
+    if expense_obj is None or expense_obj.last_update is None:
+        return False
+    # We've since seen a newer version than this one
+    when = datetime.strptime(expense["updated_at"], "%Y-%m-%dT%H:%M:%SZ")
+    return expense_obj.last_update > when
+
+
+def update_expense(api, id, currency, rate, known=None, expense=None,
+                   uow=None, step=None):
+    id = int(id)
+    rate = float(rate)
+    if uow is None:
+        uow = unit_of_work()
+        update_expense(api, id, currency, rate, known, expense, uow, step)
+        uow.flush()
+        return
+    with span("update_expense", id=id):
+        run_calls(api, update_expense_calls(
+            id, currency, rate, known, expense, uow, step))
+
+
+def checkpoint(step, state, **values):
+    # Only syncs keep a journal, not one-off updates from the web page
+    if step is not None:
+        step.advance(state, **values)
+
+
+def find_comment(comments, id, rate, old_comment_id):
+    # The comment we were adding when we last died, if it got there
+    for comment in comments:
+        if comment["deleted_at"] is not None or \
+                comment["id"] == old_comment_id or \
+                not comment["content"].lstrip().startswith("{"):
+            continue
+        try:
+            info = json.loads(comment["content"])
+        except ValueError:
+            continue
+        if info.get("updated_for") == id and \
+                same_rate(info.get("conversion_rate"), rate):
+            return comment["id"]
+    return None
+
+
+def same_rate(written, rate):
+    # The step's rate has been through the DB since the comment was written
+    if not isinstance(written, (int, float)) or rate is None:
+        return False
+    return abs(written - rate) <= 1e-6 * max(abs(written), abs(rate))
+
+
+def update_expense_calls(id, currency, rate, known, expense, uow, step):
+    # Yields each Call and gets its JSON back (see run_calls)
+    if known is None:
+        known = uow.load([id])
+    expense_obj = known.get(id)
+    state = "planned" if step is None else step.state
+    if state != "done":
+        if state != "planned":
+            # Picking up after a failed sync, so the snapshot is no good
+            expense = None
+        stale = snapshot_stale(expense, expense_obj)
+        CACHE.inc(cache="snapshot", result="miss" if stale else "hit")
+        if stale:
+            expense = (yield Call(
+                "GET", SPLITWISE_API + "get_expense/%s" % id))["expense"]
+    # Kept in step with the comments we add and delete, so the next scan
+    # doesn't fetch them all again (see comments_to_scan)
+    comments_count = None
+    if state != "done":
+        comments_count = expense.get("comments_count")
+    if step is not None:
+        original_value = step.original_value
+        original_currency = step.original_currency
+        old_comment_id = step.old_comment_id
+        comment_id = step.comment_id
+    elif expense_obj is None:
+        original_value = float(expense["cost"])
+        original_currency = expense["currency_code"]
+        old_comment_id = comment_id = None
+    else:
+        original_value = expense_obj.original_value
+        original_currency = expense_obj.original_currency
+        old_comment_id = expense_obj.comment_id
+        comment_id = None
+
+    if state != "done":
+        # Before touching anything, so a bad split doesn't leave it half
+        # done
+        with span("shares", users=len(expense["users"])):
+            cost, shares = convert_expense(
+                original_value, expense["users"], rate)
+            new_data = {"currency_code": currency, "cost": from_minor(cost)}
+            for idx, (user, (paid, owed)) in enumerate(
+                    zip(expense["users"], shares)):
+                new_data["users__array_%d__user_id" % idx] = user["user_id"]
+                new_data["users__array_%d__paid_share" % idx] = \
+                    from_minor(paid)
+                new_data["users__array_%d__owed_share" % idx] = \
+                    from_minor(owed)
+
+    if state == "commenting":
+        comments = (yield comments_call(id))["comments"]
+        comment_id = find_comment(comments, id, rate, old_comment_id)
+        if comment_id is not None:
+            state = "updating"
+    if state in ("planned", "commenting"):
+        checkpoint(step, "commenting")
+        comment = yield Call(
+            "POST", SPLITWISE_API + "create_comment",
+            {"content": json.dumps({
+                "original_currency": original_currency,
+                "original_value": original_value,
+                "updated_for": id,
+                "conversion_rate": rate
+            }), "expense_id": id})
+        if "comment" in comment:
+            comment_id = comment["comment"]["id"]
+            if comments_count is not None:
+                comments_count += 1
+        state = "updating"
+        checkpoint(step, state, comment_id=comment_id)
+    elif state == "updating" and \
+            expense["currency_code"] == currency and \
+            to_minor(expense["cost"]) == cost:
+        # The update got there, we just didn't hear back
+        state = "updated"
+
+    if state == "updating":
+        update = yield Call(
+            "PUT", SPLITWISE_API + "update_expense/%s" % id, new_data)
+        if "errors" in update and update["errors"] != {}:
+            raise Exception(update)
+        state = "updated"
+        if old_comment_id is not None:
+            checkpoint(step, state)
+
+    if state == "updated":
+        # Only now the new one is in place
+        if old_comment_id is not None:
+            yield Call(
+                "POST", SPLITWISE_API + "delete_comment/%d" % old_comment_id)
+            if comments_count is not None:
+                comments_count -= 1
+        state = "done"
+        checkpoint(step, state)
+
+    # Same as what the next comment scan would find
+    is_new = expense_obj is None
+    if is_new:
+        expense_obj = Expense(id=id)
+    expense_obj.original_value = original_value
+    expense_obj.original_currency = original_currency
+    expense_obj.comment_id = comment_id
+    expense_obj.updated_for = id
+    expense_obj.original_rate = rate
+    expense_obj.comments_count = comments_count
+    if is_new:
+        uow.insert(expense_obj)
+    else:
+        uow.update(expense_obj)
+
+
+def update_all(user, progress=None):
+    with SYNC_DURATION.time(), span("update_all", user=user.splitwise_id):
+        update_all_timed(user, progress)
+
+
+def update_all_timed(user, progress):
+    api = user.authed_api(
+        config["splitwise"]["client_id"],
+        config["splitwise"]["client_secret"])
+    currency = get_default_currency(api)
+    uow = unit_of_work()
+    # Finish off whatever an earlier sync got part way through first, so
+    # the scan doesn't see any of it half done
+    steps = SyncStep.resume(user)
+    given_up = set()
+    if len(steps) > 0:
+        logger.info("Resuming %d expenses for %r", len(steps), user)
+        run_steps(api, steps, uow, progress)
+        given_up = finish_steps(user, steps, uow)
+
+    wrong, cursor, snapshot = scan_expenses(api, user, currency, uow)
+    cursor = hold_cursor(cursor, given_up, snapshot)
+    steps, known = plan_steps(user, currency, cursor, wrong, uow, given_up)
+    run_steps(api, steps, uow, progress, len(wrong) - len(steps), known,
+              snapshot)
+    finish_sync(user, cursor, uow)
+
+
+def finish_steps(user, steps, uow):
+    # Anything that isn't done by now was given up on, and the cursor
+    # mustn't move past it (see hold_cursor)
+    given_up = set(
+        step.expense_id for step in steps if step.state != "done")
+    if len(given_up) == 0:
+        cursors = [step.cursor for step in steps if step.cursor is not None]
+        user.update(max(cursors) if len(cursors) > 0 else None)
+    uow.flush()
+    SyncStep.clear(user)
+    return given_up
+
+
+def hold_cursor(cursor, given_up, snapshot):
+    # Keeps the cursor just below whatever we gave up on that's still to be
+    # converted, so the next sync scans it again and plans it afresh
+    for id in given_up:
+        if id not in snapshot:
+            continue
+        when = datetime.strptime(
+            snapshot[id]["updated_at"], "%Y-%m-%dT%H:%M:%SZ") - \
+            timedelta(seconds=1)
+        if cursor is None or when < cursor:
+            cursor = when
+    return cursor
+
+
+def plan_steps(user, currency, cursor, wrong, uow, skip=()):
+    # Not straight back to anything we've only just given up on
+    wrong = [expense for expense in wrong if expense["id"] not in skip]
+    known = uow.load(expense["id"] for expense in wrong)
+    steps = SyncStep.plan(user, currency, cursor, [
+        (expense["id"], expense["rate"], float(expense["from_value"]),
+         expense["from_currency"],
+         known[expense["id"]].comment_id if expense["id"] in known
+         else None)
+        for expense in wrong if expense["rate"] is not None])
+    return steps, known
+
+
+def finish_sync(user, cursor, uow):
+    # Only move the cursor on now everything has been dealt with, and
+    # write it with the last chunk of expenses
+    user.update(cursor)
+    user.invalidate_wrong()
+    uow.flush()
+    SyncStep.clear(user)
+
+
+def runnable_steps(steps):
+    # Leaves the ones that keep failing for a later scan to try again from
+    # scratch
+    max_attempts = app_setting("sync_attempts", 3)
+    runnable = []
+    for step in steps:
+        if step.state != "done" and step.attempts >= max_attempts:
+            logger.warning(
+                "Giving up on expense %d after %d attempts",
+                step.expense_id, step.attempts)
+        else:
+            runnable.append(step)
+    return runnable, len(steps) - len(runnable)
+
+
+def run_steps(api, steps, uow, progress=None, failed=0, known=None,
+              snapshot=None):
+    if known is None:
+        known = uow.load(step.expense_id for step in steps)
+    if snapshot is None:
+        snapshot = {}
+    steps, given_up = runnable_steps(steps)
+    failed += given_up
+    total = len(steps) + failed
+    converted = 0
+    for step in steps:
+        if progress is not None:
+            progress(converted, total, failed)
+        try:
+            update_expense(
+                api, step.expense_id, step.currency, step.rate, known=known,
+                expense=snapshot.get(step.expense_id), uow=uow, step=step)
+        except Exception:
+            step.fail()
+            raise
+        converted += 1
+        EXPENSES_CONVERTED.inc()
+    if progress is not None:
+        progress(converted, total, failed)
+
+
+def lease_owner():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def lease_seconds():
+    return app_setting("lease_seconds", 1800.0)
+
+
+def keep_lease(user_id, progress=None):
+    # A progress callback that also renews the lease when it's half gone,
+    # and stops the sync if someone else has taken it
+    seconds = lease_seconds()
+    renewed = [time.time()]
+
+    def renew(converted, total, failed):
+        if time.time() - renewed[0] > seconds / 2:
+            if not User.claim(user_id, lease_owner(), seconds):
+                raise Exception("Lost the lease on user %d" % user_id)
+            renewed[0] = time.time()
+        if progress is not None:
+            progress(converted, total, failed)
+    return renew
+
+
+def run_job(job):
+    job_id = job.id
+    user_id = job.user_id
+    if not User.claim(user_id, lease_owner(), lease_seconds()):
+        job.requeue(app_setting("job_poll_interval", 5.0))
+        db.session.commit()
+        return False
+    try:
+        with sync_trace(job.user, profile_users()):
+            update_all(job.user, progress=keep_lease(user_id, job.progress))
+        job.finish()
+        db.session.commit()
+    except Exception as e:
+        logger.exception("Job %d failed", job_id)
+        db.session.rollback()
+        job = Job.query.get(job_id)
+        job.finish(repr(e))
+        db.session.commit()
+    finally:
+        User.release(user_id, lease_owner())
+    return True
+
+
+def run_jobs(poll):
+    while True:
+        job = Job.claim_next(lease_seconds())
+        if job is None:
+            db.session.remove()
+            time.sleep(poll)
+            continue
+        print("Running job %d for %r" % (job.id, job.user))
+        ran = run_job(job)
+        db.session.remove()
+        if not ran:
+            time.sleep(poll)
+
+
+def profile_users():
+    users = app_setting("profile_users", "")
+    return set(int(id) for id in users.split(",") if id.strip() != "")
+
+
+def sync_trace(user, profile, cprofile=False):
+    return maybe_trace(
+        user.splitwise_id in profile, "sync-%s" % user.splitwise_id,
+        app_setting("trace_dir", "traces"), cprofile,
+        splitwise_id=user.splitwise_id)
+
+
+def sync_user(user_id, profile=(), cprofile=False, backoff=None):
+    # Runs in its own thread, so has its own DB session, which is thrown
+    # away at the end. None if someone else is already syncing them.
+    start = time.time()
+    error = None
+    if not User.claim(user_id, lease_owner(), lease_seconds()):
+        return None
+    try:
+        user = User.query.get(user_id)
+        print("Updating %r" % user)
+        with sync_trace(user, profile, cprofile):
+            update_all(user, progress=keep_lease(user_id))
+        db.session.commit()
+    except Exception as e:
+        logger.exception("Failed to update user %d", user_id)
+        db.session.rollback()
+        error = e
+    finally:
+        db.session.remove()
+        # A success clears any back-off from earlier failures
+        User.release(user_id, lease_owner(), backoff if error else 0)
+    return (time.time() - start, error)
+
+
+def registered_users():
+    users = []
+    for user in User.query.all():
+        if user.splitwise_id is None:
+            print("No splitwise id for", user)
+            continue
+        users.append(user)
+    return users
+
+
+def sync_all_users(workers, profile=(), cprofile=False):
+    users = registered_users()
+    if len(users) == 0:
+        return True
+    pool = ThreadPool(max(1, min(workers, len(users))))
+    try:
+        results = pool.map(
+            lambda id: sync_user(id, profile, cprofile),
+            [user.id for user in users])
+    finally:
+        pool.close()
+    return summarise(users, results)
+
+
+def summarise(users, results):
+    print("Summary:")
+    ok = True
+    for user, result in zip(users, results):
+        if result is None:
+            print("  %r: skipped, being synced elsewhere" % user)
+            continue
+        elapsed, error = result
+        if error is None:
+            status = "ok"
+        else:
+            status = "failed (%r)" % error
+            ok = False
+        print("  %r: %s in %.1fs" % (user, status, elapsed))
+    return ok
+
+
+def run_schedule(interval, idle_interval, active_days):
+    # Works through whoever is most overdue, one at a time, paced so that
+    # everyone gets a turn over `interval`. Run as many as you like; the
+    # leases keep them off each other's users.
+    while True:
+        start = time.time()
+        users = User.query.filter(User.splitwise_id.isnot(None)).count()
+        due = User.due(interval, idle_interval, active_days)
+        db.session.remove()
+        for user_id in due:
+            # Don't keep retrying someone who's failing at every turn
+            result = sync_user(user_id, profile_users(), backoff=interval)
+            if result is not None:
+                break
+        pace = interval / max(1, users)
+        time.sleep(max(1.0, pace - (time.time() - start)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Synchronise all registered users")
+    parser.add_argument(
+        "--workers", type=int, default=app_setting("sync_workers", 1),
+        help="number of users to sync at once")
+    parser.add_argument(
+        "--worker", action="store_true",
+        help="run queued update jobs forever, rather than syncing everyone")
+    parser.add_argument(
+        "--schedule", action="store_true",
+        help="keep syncing whoever is most overdue, forever, rather than "
+             "syncing everyone once")
+    parser.add_argument(
+        "--profile", type=int, action="append", default=[],
+        metavar="SPLITWISE_ID",
+        help="write a trace of this user's sync to trace_dir "
+             "(can be given more than once)")
+    parser.add_argument(
+        "--cprofile", action="store_true",
+        help="also write a cProfile dump for each --profile user")
+    parser.add_argument(
+        "--async", dest="use_async", action="store_true",
+        help="sync everyone with asyncio rather than threads "
+             "(Python 3 only, and without --profile)")
+    parser.add_argument(
+        "--append-rates", metavar="CSV",
+        help="add the new days from an ECB rates file to rates_file")
+    args = parser.parse_args()
+    if args.use_async and len(args.profile) > 0:
+        parser.error("--profile doesn't work with --async")
+    if db is None:
+        from database import Database
+        logging.basicConfig()
+        setup(Database(config["app"]["database_uri"]))
+    if args.append_rates is not None:
+        rates_file = app_setting("rates_file", "")
+        if rates_file == "" or rates_file.endswith(".zip"):
+            parser.error("--append-rates needs rates_file to be a CSV")
+        added = Rate.offline.append_file(args.append_rates)
+        Rate.offline.write(rates_file)
+        print("Added %d days of rates to %s" % (added, rates_file))
+    else:
+        check_schema()
+        if args.worker:
+            run_jobs(app_setting("job_poll_interval", 5.0))
+        elif args.schedule:
+            run_schedule(
+                app_setting("sync_interval", 3600.0),
+                app_setting("idle_sync_interval", 86400.0),
+                app_setting("active_days", 14))
+        else:
+            if args.use_async:
+                import aiosync
+                ok = aiosync.sync_all_users(args.workers)
+            else:
+                ok = sync_all_users(
+                    args.workers, set(args.profile) | profile_users(),
+                    args.cprofile)
+            print(metrics.render())
+            if not ok:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    # Through the importable module, so aiosync sees what setup() does
+    import sync
+    sync.main()
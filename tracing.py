@@ -0,0 +1,141 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+
+# Opt-in span trees for diagnosing a single slow sync or request. Nothing
+# is recorded unless a Trace is active in the current thread (or was
+# handed to a pool thread with wrap()).
+
+_local = threading.local()
+
+
+class Span(object):
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.end = None
+        self.children = []
+
+    def finish(self):
+        self.end = time.time()
+
+    def to_dict(self, origin):
+        end = self.end if self.end is not None else time.time()
+        return {
+            "name": self.name,
+            "attrs": self.attrs,
+            "start": round(self.start - origin, 6),
+            "duration": round(end - self.start, 6),
+            "children": [child.to_dict(origin) for child in self.children]}
+
+
+def current():
+    return getattr(_local, "span", None)
+
+
+@contextmanager
+def span(name, **attrs):
+    parent = current()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, attrs)
+    parent.children.append(child)
+    _local.span = child
+    try:
+        yield child
+    finally:
+        child.finish()
+        _local.span = parent
+
+
+def wrap(fn):
+    # For thread pools, so the worker's spans go under the caller's
+    parent = current()
+    if parent is None:
+        return fn
+
+    def run(*args, **kwargs):
+        previous = current()
+        _local.span = parent
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.span = previous
+    return run
+
+
+def maybe_trace(enabled, name, directory, profile=False, **attrs):
+    # Otherwise it's just a span in whatever trace is already going
+    if enabled:
+        return Trace(name, directory, profile, **attrs)
+    return span(name, **attrs)
+
+
+class Trace(object):
+    def __init__(self, name, directory, profile=False, **attrs):
+        self.name = name
+        self.directory = directory
+        self.profile = profile
+        self.attrs = attrs
+        self.path = None
+
+    def __enter__(self):
+        self.previous = current()
+        self.root = Span(self.name, self.attrs)
+        _local.span = self.root
+        self.profiler = None
+        if self.profile:
+            # Only sees this thread, not the comment/rate pools
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.root.finish()
+        _local.span = self.previous
+        self.write()
+
+    def write(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        stem = os.path.join(self.directory, "%s-%s" % (
+            "".join(c if c.isalnum() else "_" for c in self.name),
+            time.strftime("%Y%m%d-%H%M%S")))
+        self.path = stem + ".json"
+        with open(self.path, "w") as f:
+            json.dump(self.root.to_dict(self.root.start), f, indent=1)
+        if self.profiler is not None:
+            self.profiler.dump_stats(stem + ".prof")
+
+
+def trace_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        parent = current()
+        if parent is None:
+            return
+        child = Span("db", {"statement": statement[:200]})
+        parent.children.append(child)
+        conn.info.setdefault("trace_spans", []).append(child)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get("trace_spans")
+        if spans:
+            spans.pop().finish()
+
+    @event.listens_for(engine, "handle_error")
+    def failed(context):
+        if context.connection is None:
+            return
+        spans = context.connection.info.get("trace_spans")
+        if spans:
+            spans.pop().finish()
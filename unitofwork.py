@@ -0,0 +1,78 @@
+class UnitOfWork(object):
+    # Collects the rows a sync creates and changes, and writes them with
+    # bulk upserts/updates, one transaction per chunk. Rows it hands out
+    # are detached from the session, so nothing gets written behind its
+    # back by autoflush.
+
+    def __init__(self, session, model, size=200):
+        self.session = session
+        self.model = model
+        self.size = size
+        self.inserts = {}
+        self.updates = {}
+
+    def load(self, ids):
+        found = {}
+        missing = []
+        for id in set(ids):
+            if id in self.inserts:
+                found[id] = self.inserts[id]
+            elif id in self.updates:
+                found[id] = self.updates[id]
+            else:
+                missing.append(id)
+        for id, row in self.model.load_many(missing).items():
+            self.session.expunge(row)
+            found[id] = row
+        return found
+
+    def insert(self, row):
+        self.inserts[row.id] = row
+        self._maybe_flush()
+
+    def update(self, row):
+        # New rows are written with whatever values they have at the time
+        if row.id not in self.inserts:
+            self.updates[row.id] = row
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self.inserts) + len(self.updates) >= self.size:
+            self.flush()
+
+    def _values(self, row):
+        return dict(
+            (column.key, getattr(row, column.key))
+            for column in self.model.__mapper__.column_attrs)
+
+    def _upsert(self):
+        # Expense ids are Splitwise's, so another group member's sync can
+        # insert the same one first. Whoever writes last wins, as with
+        # updates.
+        table = self.model.__table__
+        dialect = self.session.get_bind().dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+            query = insert(table)
+            return query.on_conflict_do_update(
+                index_elements=list(table.primary_key.columns),
+                set_=dict(
+                    (column.name, query.excluded[column.name])
+                    for column in table.columns
+                    if not column.primary_key))
+        if dialect == "sqlite":
+            return table.insert().prefix_with("OR REPLACE")
+        return table.insert()
+
+    def flush(self):
+        if len(self.inserts) > 0:
+            self.session.execute(
+                self._upsert(),
+                [self._values(row) for row in self.inserts.values()])
+        if len(self.updates) > 0:
+            self.session.bulk_update_mappings(
+                self.model, [self._values(row)
+                             for row in self.updates.values()])
+        self.session.commit()
+        self.inserts = {}
+        self.updates = {}